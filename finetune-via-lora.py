@@ -1,46 +1,77 @@
 #!/usr/bin/env python3
-import json
 import argparse
+import os
+import numpy as np
 from datasets import Dataset
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     TrainingArguments,
     Trainer,
-    DataCollatorForLanguageModeling,
+    DataCollatorForSeq2Seq,
 )
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 import torch
 
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+# Upper bound on cached prompt encodings; prompts embed whole diffs, so keep it modest
+PROMPT_CACHE_SIZE = 4096
+
 def load_dataset(data_path, tokenizer):
-    data = []
-    with open(data_path, "r") as f:
-        for line in f:
-            sample = json.loads(line)
-            data.append({
-                "prompt": sample["prompt"],
-                "target": sample["target"].strip() + (tokenizer.eos_token or "")
-            })
+    eos_token = tokenizer.eos_token or ""
+    with open(data_path, "rb") as f:
+        lines = f.read().splitlines()
+    data = [
+        {"prompt": sample["prompt"], "target": sample["target"].strip() + eos_token}
+        for sample in map(json.loads, filter(None, lines))
+    ]
     return Dataset.from_list(data)
 
-def tokenize_function(examples, tokenizer, max_length):
-    batch_input_ids = []
-    batch_attention_mask = []
-    batch_labels = []
+def encode_prompts(prompts, tokenizer, cache):
+    """Batch-encodes prompts, reusing the ids of prompts already seen in `cache`."""
+    missing = list(dict.fromkeys(p for p in prompts if p not in cache))
+    if missing:
+        if len(cache) + len(missing) > PROMPT_CACHE_SIZE:
+            cache.clear()
+        encoded = tokenizer(missing, add_special_tokens=False, return_attention_mask=False)["input_ids"]
+        for prompt, ids in zip(missing, encoded):
+            cache[prompt] = np.asarray(ids, dtype=np.int32)
+    return [cache[p] for p in prompts]
 
+def tokenize_function(examples, tokenizer, max_length, prompt_cache=None):
     bos_token_id = tokenizer.bos_token_id
     eos_token_id = tokenizer.eos_token_id
-    pad_token_id = tokenizer.pad_token_id
 
-    for prompt, target in zip(examples["prompt"], examples["target"]):
-        prompt_ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
-        target_ids = tokenizer(target, add_special_tokens=False)["input_ids"]
+    # Encode the whole map-batch in one call per column so the fast tokenizer
+    # can parallelize internally instead of paying per-sample call overhead.
+    # Identical prompts (cherry-picked or forked commits) are only encoded once.
+    if prompt_cache is None:
+        prompt_cache = {}
+    batch_prompt_ids = encode_prompts(examples["prompt"], tokenizer, prompt_cache)
+    target_enc = tokenizer(examples["target"], add_special_tokens=False, return_attention_mask=False)
+
+    # Rows are written into preallocated arrays with slice assignments instead of
+    # building Python lists token by token. No padding is added here: the data
+    # collator pads each training batch to its own longest sequence.
+    n = len(batch_prompt_ids)
+    batch_input_ids = np.zeros((n, max_length), dtype=np.int32)
+    batch_labels = np.full((n, max_length), -100, dtype=np.int32)
+    seq_lens = np.zeros(n, dtype=np.int64)
+
+    start = 0
+    if bos_token_id is not None:
+        batch_input_ids[:, 0] = bos_token_id
+        start = 1
+
+    for row, (prompt_ids, target_ids) in enumerate(zip(batch_prompt_ids, target_enc["input_ids"])):
         if eos_token_id is not None:
             target_ids.append(eos_token_id)
 
-        total_len = len(prompt_ids) + len(target_ids)
-        if bos_token_id is not None:
-            total_len += 1
+        total_len = len(prompt_ids) + len(target_ids) + start
 
         if total_len > max_length:
             excess = total_len - max_length
@@ -53,39 +84,44 @@ def tokenize_function(examples, tokenizer, max_length):
                 # Truncate prompt from the LEFT
                 prompt_ids = prompt_ids[excess:]
 
-        input_ids = []
-        if bos_token_id is not None:
-            input_ids.append(bos_token_id)
-        input_ids.extend(prompt_ids)
-        input_ids.extend(target_ids)
-
-        # Pad to max_length
-        if len(input_ids) < max_length:
-            attention_mask = [1] * len(input_ids) + [0] * (max_length - len(input_ids))
-            input_ids = input_ids + [pad_token_id] * (max_length - len(input_ids))
-        else:
-            attention_mask = [1] * max_length
-            input_ids = input_ids[:max_length]
-
-        # Build labels
-        labels = input_ids.copy()
-        prompt_len = len(prompt_ids) + (1 if bos_token_id is not None else 0)
-        for i in range(prompt_len):
-            labels[i] = -100
-        for i in range(len(input_ids)):
-            if attention_mask[i] == 0:
-                labels[i] = -100
-
-        batch_input_ids.append(input_ids)
-        batch_attention_mask.append(attention_mask)
-        batch_labels.append(labels)
+        prompt_end = min(start + len(prompt_ids), max_length)
+        seq_end = min(prompt_end + len(target_ids), max_length)
+
+        batch_input_ids[row, start:prompt_end] = prompt_ids[: prompt_end - start]
+        batch_input_ids[row, prompt_end:seq_end] = target_ids[: seq_end - prompt_end]
+        seq_lens[row] = seq_end
+
+        # Only target tokens contribute to the loss
+        batch_labels[row, prompt_end:seq_end] = batch_input_ids[row, prompt_end:seq_end]
 
     return {
-        "input_ids": batch_input_ids,
-        "attention_mask": batch_attention_mask,
-        "labels": batch_labels,
+        "input_ids": [ids[:length] for ids, length in zip(batch_input_ids, seq_lens)],
+        "attention_mask": [np.ones(length, dtype=np.int8) for length in seq_lens],
+        "labels": [labels[:length] for labels, length in zip(batch_labels, seq_lens)],
+        # Used by the length-grouped sampler; dropped by the Trainer before collation
+        "length": seq_lens,
     }
 
+def set_gradient_checkpointing_interval(model, interval):
+    """Checkpoint only every `interval`-th decoder layer; the others keep their activations."""
+    base_model = model.get_base_model()
+    # Only thins existing checkpointing; prepare_model_for_kbit_training turns it on for
+    # quantized (--fourbit) models, otherwise nothing is checkpointed to begin with
+    if not base_model.is_gradient_checkpointing:
+        print("Warning: --gc_interval has no effect, gradient checkpointing is not enabled (it is with --fourbit)")
+        return
+    layers = getattr(getattr(base_model, "model", None), "layers", None)
+    # Only layers that checkpoint themselves (per-layer flag plus the function installed by
+    # gradient_checkpointing_enable) can be toggled individually
+    if layers is None or not all(
+        hasattr(layer, "gradient_checkpointing") and hasattr(layer, "_gradient_checkpointing_func") for layer in layers
+    ):
+        print(f"Warning: --gc_interval is not supported for {type(base_model).__name__}, checkpointing every layer")
+        return
+    for i, layer in enumerate(layers):
+        layer.gradient_checkpointing = i % interval == 0
+
+
 def main():
     parser = argparse.ArgumentParser(description="Train LoRA for commit message generation with optional validation.")
     # Model & Tokenizer
@@ -95,6 +131,12 @@ def main():
     # Data
     parser.add_argument("--data_path", type=str, required=True, help="Path to training JSONL file.")
     parser.add_argument("--eval_data_path", type=str, default=None, help="Optional path to validation JSONL file.")
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=min(16, os.cpu_count() or 1),
+        help="Number of processes used to tokenize the datasets."
+    )
 
     # LoRA
     parser.add_argument("--lora_r", type=int, default=8)
@@ -122,13 +164,37 @@ def main():
     parser.add_argument("--eval_steps", type=int, default=None, help="If None, defaults to logging_steps.")
     parser.add_argument("--fp16", action="store_true")
     parser.add_argument("--bf16", action="store_true")
+    parser.add_argument(
+        "--pure_bf16",
+        action="store_true",
+        help="Keep weights, LoRA adapters and gradients in bf16 instead of fp32 mixed precision (Ampere+ GPUs)."
+    )
     parser.add_argument("--fourbit", action="store_true")
     parser.add_argument("--optim", type=str, default="paged_adamw_8bit")
+    parser.add_argument(
+        "--gc_interval",
+        type=int,
+        default=1,
+        help="With gradient checkpointing enabled (--fourbit), checkpoint only every Nth decoder layer (1 = every layer)."
+    )
+    parser.add_argument(
+        "--fsdp",
+        action="store_true",
+        help="Shard the frozen base model across GPUs with FSDP2. Launch with torchrun."
+    )
 
     # Save
     parser.add_argument("--final_save_path", type=str, default="commit-message-lora")
 
     args = parser.parse_args()
+    if args.pure_bf16:
+        if args.fp16:
+            parser.error("--pure_bf16 cannot be combined with --fp16")
+        args.bf16 = True
+    if args.gc_interval < 1:
+        parser.error("--gc_interval must be >= 1")
+    if args.fsdp and args.fourbit:
+        parser.error("--fsdp cannot be combined with --fourbit (quantized weights cannot be sharded here)")
 
     # ===== Tokenizer =====
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
@@ -142,37 +208,45 @@ def main():
         eval_dataset = load_dataset(args.eval_data_path, tokenizer)
 
     # ===== Tokenize =====
+    prompt_cache = {}
     def tokenize_fn(examples):
-        return tokenize_function(examples, tokenizer, args.max_length)
-    tokenized_train = train_dataset.map(tokenize_fn, batched=True, remove_columns=train_dataset.column_names)
+        return tokenize_function(examples, tokenizer, args.max_length, prompt_cache)
+    map_kwargs = dict(
+        batched=True,
+        batch_size=1000,
+        num_proc=args.num_proc if args.num_proc > 1 else None,
+        writer_batch_size=10000,
+    )
+    tokenized_train = train_dataset.map(tokenize_fn, remove_columns=train_dataset.column_names, **map_kwargs)
     tokenized_eval = None
     if eval_dataset is not None:
-        tokenized_eval = eval_dataset.map(tokenize_fn, batched=True, remove_columns=eval_dataset.column_names)
-
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_name,
-        load_in_4bit=args.fourbit,
-        device_map="auto",
-        torch_dtype=torch.bfloat16 if args.bf16 else torch.float16,
-    )
-    model = prepare_model_for_kbit_training(model)
-    model.resize_token_embeddings(len(tokenizer))
-
-    peft_config = LoraConfig(
-        r=args.lora_r,
-        lora_alpha=args.lora_alpha,
-        target_modules=args.lora_modules,
-        lora_dropout=args.lora_dropout,
-        bias="none",
-        task_type="CAUSAL_LM"
-    )
-    model = get_peft_model(model, peft_config)
-    model.print_trainable_parameters()
+        tokenized_eval = eval_dataset.map(tokenize_fn, remove_columns=eval_dataset.column_names, **map_kwargs)
 
     # ===== Training Args =====
     eval_strategy = "no"
     if tokenized_eval is not None:
-        eval_strategy = args.evaluation_strategy
+        eval_strategy = args.eval_strategy
+
+    # FSDP2 shards the frozen backbone across ranks. Decoder blocks are wrapped
+    # via the model's `_no_split_modules`, and with cpu_ram_efficient_loading
+    # only rank 0 materializes the checkpoint; the other ranks load on the meta
+    # device and receive the weights by broadcast. The training arguments must
+    # therefore exist before `from_pretrained` is called.
+    # The LoRA adapters live inside those blocks and are sharded with them: they
+    # ride in the block's single all-gather, while FSDP also reduces their
+    # gradients and gathers them for saving. Leaving them out via ignored
+    # params would need manual gradient all-reduce and identical init per rank.
+    fsdp_kwargs = {}
+    if args.fsdp:
+        fsdp_kwargs = dict(
+            fsdp="full_shard auto_wrap",
+            fsdp_config={
+                "version": 2,
+                "reshard_after_forward": True,
+                "cpu_ram_efficient_loading": True,
+                "state_dict_type": "SHARDED_STATE_DICT",
+            },
+        )
 
     training_args = TrainingArguments(
         output_dir=args.output_dir,
@@ -190,10 +264,44 @@ def main():
         eval_steps=args.eval_steps or args.logging_steps,
         fp16=args.fp16,
         bf16=args.bf16,
+        bf16_full_eval=args.pure_bf16,
+        tf32=True if args.pure_bf16 else None,
         optim=args.optim,
         report_to="none",
-        load_best_model_at_end=True,
+        # Batch samples of similar length together so dynamic padding stays small
+        group_by_length=True,
+        length_column_name="length",
+        load_best_model_at_end=tokenized_eval is not None,
+        **fsdp_kwargs,
+    )
+
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_name,
+        load_in_4bit=args.fourbit,
+        device_map=None if args.fsdp else "auto",
+        torch_dtype=torch.bfloat16 if args.bf16 else torch.float16,
+    )
+    model = prepare_model_for_kbit_training(model)
+    model.resize_token_embeddings(len(tokenizer))
+
+    peft_config = LoraConfig(
+        r=args.lora_r,
+        lora_alpha=args.lora_alpha,
+        target_modules=args.lora_modules,
+        lora_dropout=args.lora_dropout,
+        bias="none",
+        task_type="CAUSAL_LM"
     )
+    model = get_peft_model(model, peft_config)
+    if args.pure_bf16:
+        # prepare_model_for_kbit_training upcasts every non-quantized weight to
+        # fp32 and LoRA adapters are created in fp32; cast them back to bf16
+        for param in model.parameters():
+            if param.dtype == torch.float32:
+                param.data = param.data.to(torch.bfloat16)
+    if args.gc_interval > 1:
+        set_gradient_checkpointing_interval(model, args.gc_interval)
+    model.print_trainable_parameters()
 
     # ===== Trainer =====
     trainer = Trainer(
@@ -201,15 +309,22 @@ def main():
         args=training_args,
         train_dataset=tokenized_train,
         eval_dataset=tokenized_eval,
-        data_collator=DataCollatorForLanguageModeling(tokenizer, mlm=False),
+        # Pads input_ids/attention_mask per batch and labels with -100, keeping the prompt masking
+        data_collator=DataCollatorForSeq2Seq(tokenizer, padding=True, pad_to_multiple_of=8, label_pad_token_id=-100),
     )
 
     # ===== Train =====
     trainer.train()
 
     # ===== Save =====
-    model.save_pretrained(args.final_save_path)
-    tokenizer.save_pretrained(args.final_save_path)
+    if trainer.is_fsdp_enabled:
+        # Gather the sharded adapter weights so rank 0 writes a regular checkpoint
+        trainer.accelerator.state.fsdp_plugin.set_state_dict_type("FULL_STATE_DICT")
+        trainer.save_model(args.final_save_path)
+    else:
+        model.save_pretrained(args.final_save_path)
+    if trainer.is_world_process_zero():
+        tokenizer.save_pretrained(args.final_save_path)
 
 if __name__ == "__main__":
     main()
@@ -3,19 +3,32 @@ import os
 import argparse
 import subprocess
 import concurrent.futures
+import itertools
+import multiprocessing
+from collections import deque
+from dataclasses import dataclass
 import re
+import shutil
 import sys
+import threading
 from tqdm import tqdm
 import pygit2
+import orjson
 
 try:
-    import orjson
+    import zstandard
 
-    HAS_ORJSON = True
+    HAS_ZSTD = True
 except ImportError:
-    HAS_ORJSON = False
+    HAS_ZSTD = False
+
+def available_cpus():
+    """CPUs this process may run on (affinity-aware where supported)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-import json
 
 DEFAULTS = {
     "repos_dir": "repos",
@@ -23,50 +36,61 @@ DEFAULTS = {
     "max_commits": 1000,
     "max_diff_size": 50000,
     "max_contrib_size": 10000,
-    "threads": 4,
+    "threads": available_cpus(),
+    "diff_threads": 4,
+    "large_tree_threshold": 20000,
 }
 
+# Serialized entries are batched and written out in chunks of at least 1 MiB
+WRITE_BUFFER_SIZE = 1 << 20
+
+# zstd level for --zstd output; JSONL diffs already shrink 5-10x at this cheap level
+ZSTD_LEVEL = 3
+
+# Well-known id of the empty tree; libgit2 resolves it even if it was never written
+EMPTY_TREE_OID = pygit2.Oid(hex="4b825dc642cb6eb9a060e54bf8d69288fbee4904")
+
 REGEX_FILTER_MERGE = re.compile(r"^[Mm]erge\s")
 REGEX_FILTER_REVERT = re.compile(r"^[Rr]evert\s")
 BOT_PATTERN = re.compile(r"\b(?:bot|robot)\b|\[bot\]", re.IGNORECASE)
+# Issue references ("fixes #12", "(#34)", "#56") stripped from subjects in a single pass
+REGEX_ISSUE_REF = re.compile(r"(?i)\b(?:fixes|closes|resolves|related|addresses?)\s*#[0-9]+\b|\s*\(#[0-9]+\)|\b#[0-9]+\b")
+REGEX_WHITESPACE = re.compile(r"\s+")
 
 
-def get_empty_tree(repo):
-    builder = repo.TreeBuilder()
-    return repo[builder.write()]
-
 def clamp(x, min_val, max_val):
     return max(min_val, min(x, max_val))
 
 
-def serialize_json(data):
-    """Serializes data using orjson or standard json fallback."""
-    if HAS_ORJSON:
-        return orjson.dumps(data) + b"\n"
-    else:
-        import json
-
-        return (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
-
-
 def clean_message(msg):
     """Sanitizes commit subjects."""
     if not msg:
         return ""
     lines = msg.strip().split("\n")
     subject = lines[0].strip()
-    subject = re.sub(r"(?i)\b(fixes|closes|resolves|related|addresses?)\s*#[0-9]+\b", "", subject)
-    subject = re.sub(r"\s*\(#[0-9]+\)", "", subject)
-    subject = re.sub(r"\b#[0-9]+\b", "", subject)
-    subject = re.sub(r"\s+", " ", subject)
+    if "#" in subject:  # most subjects carry no issue reference
+        subject = REGEX_ISSUE_REF.sub("", subject)
+    subject = REGEX_WHITESPACE.sub(" ", subject)
     return subject.strip().strip(".,;:!?")
 
 
-def get_repo_metadata(repo_path, include_license=False):
-    """Extracts metadata; ignores external tool failures but reports them."""
+def open_output(path, compress=False):
+    """Opens a repo's output file for binary writing, zstd-compressed if requested."""
+    # process_repo hands over whole batches, which BufferedWriter passes straight through
+    f = open(path, "wb")
+    if compress:
+        # Single-threaded: the repo-level process pool already occupies every CPU
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f)
+    return f
+
+
+def get_repo_metadata(repo, repo_path, include_license=False, licensee_bin=None):
+    """Extracts metadata; ignores external tool failures but reports them.
+
+    licensee_bin is the resolved path of the licensee executable, or None if it is not installed.
+    """
     meta = {"license": "Unknown"}
     try:
-        repo = pygit2.Repository(repo_path)
         for remote in repo.remotes:
             if remote.url:
                 meta["repo_source"] = remote.url
@@ -74,21 +98,23 @@ def get_repo_metadata(repo_path, include_license=False):
     except (pygit2.GitError, KeyError) as e:
         print(f"  ⚠️  Could not get remotes for {repo_path}: {type(e).__name__}")
 
-    if include_license:
+    if include_license and licensee_bin is None:
+        meta["license"] = "No License (tool missing)"
+    elif include_license:
         try:
             lic_out = subprocess.run(
-                ["licensee", "detect", "--json", repo_path],
+                [licensee_bin, "detect", "--json", repo_path],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,
                 text=True,
             )
-            lic_data = json.loads(lic_out.stdout)
+            lic_data = orjson.loads(lic_out.stdout)
             lic = lic_data.get("licenses", [])
             if not lic:
                 meta["license"] = "No License"
             else:
                 meta["license"] = lic[0].get("spdx_id") or lic[0].get("key", "Unknown")
-        except (subprocess.CalledProcessError, json.JSONDecodeError, FileNotFoundError) as e:
+        except (subprocess.CalledProcessError, orjson.JSONDecodeError, FileNotFoundError) as e:
             meta["license"] = f"Detection Failed: {type(e).__name__}"
 
     contrib_content = ""
@@ -104,32 +130,376 @@ def get_repo_metadata(repo_path, include_license=False):
 
     return meta, contrib_content
 
+
+def large_blob_size(repo, oid, mode, max_diff_size):
+    """Returns the size of a text blob larger than max_diff_size, else None.
+
+    The size comes from the object header alone; only blobs over the limit are loaded, so
+    binary ones keep git's own short "Binary files ... differ" line.
+    """
+    # A submodule (gitlink) points at a commit in another repository, not at a local blob
+    if mode == pygit2.GIT_FILEMODE_COMMIT:
+        return None
+    try:
+        _, size = repo.odb.read_header(oid)
+        if size <= max_diff_size or repo[oid].is_binary:
+            return None
+    except KeyError:
+        # Missing objects (shallow or partial clones) are left to the regular patch path
+        return None
+    return size
+
+
+def large_blob_placeholder(path, added, size):
+    """Stands in for the patch of a whole-file add/delete of a large text blob."""
+    return f"diff --git a/{path} b/{path}\n{'new' if added else 'deleted'} file, {size} bytes ...TRUNCATED_LARGE\n"
+
+
+def get_large_blob_size(repo, delta, max_diff_size):
+    """large_blob_size() of a delta that adds or deletes a whole file; None for other deltas."""
+    if delta.status == pygit2.GIT_DELTA_ADDED:
+        side = delta.new_file
+    elif delta.status == pygit2.GIT_DELTA_DELETED:
+        side = delta.old_file
+    else:
+        return None
+    return large_blob_size(repo, side.id, side.mode, max_diff_size)
+
+
 def get_commit_diff_and_files(repo, commit, max_diff_size):
     diff_text = []
-    affected_files = set()
+    # Insertion-ordered dict as a set: paths stay in git's delta order, no per-commit sort
+    affected_files = {}
 
     if commit.parents:
         diff = repo.diff(commit.parents[0].tree, commit.tree)
     else:
-        empty_tree = get_empty_tree(repo)
-        diff = repo.diff(empty_tree, commit.tree)
-
-    for patch in diff:
-        if patch.delta.new_file:
-            affected_files.add(patch.delta.new_file.path)
-        if patch.delta.old_file:
-            affected_files.add(patch.delta.old_file.path)
-
-        diff_text.append(patch.text)
+        diff = repo.diff(repo[EMPTY_TREE_OID], commit.tree)
+
+    # Deltas carry the file paths without generating any patch text
+    deltas = list(diff.deltas)
+    for delta in deltas:
+        if delta.new_file:
+            affected_files[delta.new_file.path] = None
+        if delta.old_file:
+            affected_files[delta.old_file.path] = None
+
+    # Patches are only materialized until the size budget is used up
+    total_len = 0
+    for idx, delta in enumerate(deltas):
+        blob_size = get_large_blob_size(repo, delta, max_diff_size)
+        if blob_size is not None:
+            # The patch would be the whole blob; skip inflating and diffing it
+            text = large_blob_placeholder(
+                delta.new_file.path, delta.status == pygit2.GIT_DELTA_ADDED, blob_size
+            )
+        else:
+            text = diff[idx].text
 
-        if sum(len(d) for d in diff_text) > max_diff_size:
+        diff_text.append(text)
+        total_len += len(text)
+        if total_len > max_diff_size:
             break
 
     joined = "".join(diff_text)
     if len(joined) > max_diff_size:
         joined = joined[:max_diff_size] + "...TRUNCATED"
 
-    return joined, sorted(affected_files)
+    return joined, list(affected_files)
+
+
+# C escapes git uses when quoting paths in diff headers
+GIT_QUOTE_ESCAPES = {
+    0x07: b"\\a", 0x08: b"\\b", 0x09: b"\\t", 0x0A: b"\\n", 0x0B: b"\\v", 0x0C: b"\\f", 0x0D: b"\\r",
+    0x22: b'\\"', 0x5C: b"\\\\",
+}
+
+
+def git_quote_path(path):
+    """Quotes a path the way git prints it in a "diff --git" header (core.quotePath=true)."""
+    if not any(byte < 0x20 or byte >= 0x7F or byte in (0x22, 0x5C) for byte in path):
+        return path
+    quoted = bytearray(b'"')
+    for byte in path:
+        if byte in GIT_QUOTE_ESCAPES:
+            quoted += GIT_QUOTE_ESCAPES[byte]
+        elif byte < 0x20 or byte >= 0x7F:
+            quoted += b"\\%03o" % byte
+        else:
+            quoted.append(byte)
+    quoted += b'"'
+    return bytes(quoted)
+
+
+class LargeSectionFilter:
+    """Replaces whole file sections of a streamed `git diff-tree -p` patch with placeholders.
+
+    A section starts with its "diff --git" header line and runs to the next one; patch lines
+    always start with a diff marker, so "\\ndiff --git " only occurs at section starts. Bytes
+    that may be the start of a header split across reads are held back until the next feed().
+    """
+
+    SECTION_START = b"\ndiff --git "
+
+    def __init__(self, replacements):
+        # Header line (as git prints it, including "\\n") -> placeholder bytes
+        self.replacements = replacements
+        self.hold = max(map(len, replacements))
+        self.pending = bytearray()
+        self.line_start = True
+        self.skipping = False
+
+    def feed(self, data, final=False):
+        """Returns the filtered bytes that can be released so far."""
+        buf = self.pending
+        buf += data
+        out = bytearray()
+        while buf:
+            if self.skipping:
+                pos = buf.find(self.SECTION_START)
+                if pos < 0:
+                    keep = 0 if final else min(len(buf), len(self.SECTION_START) - 1)
+                    del buf[: len(buf) - keep]
+                    break
+                del buf[: pos + 1]
+                self.skipping = False
+                self.line_start = True
+                continue
+            hit = None
+            for header in self.replacements:
+                if self.line_start and buf.startswith(header):
+                    pos = 0
+                else:
+                    pos = buf.find(b"\n" + header)
+                    if pos < 0:
+                        continue
+                    pos += 1
+                if hit is None or pos < hit[0]:
+                    hit = (pos, header)
+            if hit is None:
+                release = len(buf) if final else max(len(buf) - self.hold, 0)
+                if release:
+                    out += buf[:release]
+                    self.line_start = buf[release - 1] == 0x0A
+                    del buf[:release]
+                break
+            pos, header = hit
+            out += buf[:pos]
+            out += self.replacements[header]
+            del buf[: pos + len(header)]
+            self.skipping = True
+        return out
+
+
+def write_commit_ids(stdin, commit_ids):
+    """Feeds commit ids to a `git diff-tree --stdin` process, then closes its stdin."""
+    try:
+        for commit_id in commit_ids:
+            stdin.write(f"{commit_id}\n".encode("ascii"))
+        stdin.close()
+    except BrokenPipeError:
+        pass
+
+def iter_commit_diffs_cli(repo, repo_path, commit_ids, max_diff_size):
+    """Yields (diff_text, affected_files) per commit id, in order, from one `git diff-tree --stdin`.
+
+    libgit2's tree-to-tree diff gets very slow on huge trees while git stays fast, and a
+    single git process amortizes its startup and attribute lookups over the whole repo.
+    Each commit is emitted as "<oid>\\0", raw "<meta>\\0<path>\\0" records plus one extra
+    NUL, then the patch text. Patch text may itself contain NULs (git only sniffs the first
+    8000 bytes for binary content), so it is ended by the exact next header instead: every
+    patch line starts with a diff marker, so "\\n<next oid>\\0" cannot occur inside a patch.
+    Whole-file adds/deletes of large text blobs get the same placeholder as the pygit2 path.
+    """
+    cmd = [
+        "git", "-c", "core.quotePath=true", "-C", repo_path, "diff-tree", "--stdin", "--always", "-r", "--root", "--no-renames",
+        "--no-color", "--no-ext-diff", "--raw", "-z", "-p",
+    ]
+    headers = [str(commit_id).encode("ascii") + b"\0" for commit_id in commit_ids]
+    # The budget is in characters; UTF-8 needs at most 4 bytes per character, so keeping this
+    # many bytes always decodes to more than max_diff_size characters when anything is dropped
+    byte_budget = 4 * max_diff_size + 4
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        # Written from a thread so git never stalls on a full stdout pipe while we write
+        feeder = threading.Thread(target=write_commit_ids, args=(proc.stdin, commit_ids), daemon=True)
+        feeder.start()
+        buf = bytearray()
+
+        def fill():
+            chunk = proc.stdout.read1(1 << 16)
+            buf.extend(chunk)
+            return bool(chunk)
+
+        for i, header in enumerate(headers):
+            while len(buf) < len(header) and fill():
+                pass
+            if not buf.startswith(header):
+                raise RuntimeError(f"Unexpected git diff-tree output for {header[:-1].decode()} in {repo_path}")
+            del buf[: len(header)]
+
+            affected_files = {}
+            large_sections = {}
+            while True:
+                while not buf and fill():
+                    pass
+                if buf[:1] != b":":
+                    break
+                meta_end = buf.find(b"\0")
+                path_end = buf.find(b"\0", meta_end + 1) if meta_end >= 0 else -1
+                while path_end < 0:
+                    if not fill():
+                        raise RuntimeError(f"git diff-tree output ended inside a raw record in {repo_path}")
+                    meta_end = buf.find(b"\0")
+                    path_end = buf.find(b"\0", meta_end + 1) if meta_end >= 0 else -1
+                path = bytes(buf[meta_end + 1 : path_end])
+                affected_files[path.decode("utf-8", errors="replace")] = None
+                # ":<src mode> <dst mode> <src oid> <dst oid> <status>"; ids are always full length
+                src_mode, dst_mode, src_oid, dst_oid, status = buf[1:meta_end].decode("ascii").split(" ")
+                if status in ("A", "D"):
+                    added = status == "A"
+                    size = large_blob_size(
+                        repo,
+                        pygit2.Oid(hex=dst_oid if added else src_oid),
+                        int(dst_mode if added else src_mode, 8),
+                        max_diff_size,
+                    )
+                    if size is not None:
+                        header = b"diff --git " + git_quote_path(b"a/" + path) + b" " + git_quote_path(b"b/" + path) + b"\n"
+                        placeholder = large_blob_placeholder(path.decode("utf-8", errors="replace"), added, size)
+                        large_sections[header] = placeholder.encode("utf-8")
+                del buf[: path_end + 1]
+            if affected_files:
+                while not buf and fill():
+                    pass
+                if buf[:1] == b"\0":
+                    del buf[:1]
+
+            # Patch text runs up to the next header (or EOF); bytes past the budget are dropped
+            next_header = headers[i + 1] if i + 1 < len(headers) else b""
+            marker = b"\n" + next_header if next_header else b""
+            text = bytearray()
+            dropped = False
+            section_filter = LargeSectionFilter(large_sections) if large_sections else None
+            # An empty patch is followed directly by the next header
+            while next_header and len(buf) < len(next_header) and fill():
+                pass
+            if next_header and buf.startswith(next_header):
+                end = 0
+            else:
+                while True:
+                    pos = buf.find(marker) if marker else -1
+                    if pos >= 0:
+                        end = pos + 1
+                        break
+                    # Hold back a tail that could be the start of a marker split across reads
+                    safe = len(buf) - max(len(marker) - 1, 0)
+                    if safe > 0:
+                        if len(text) <= byte_budget:
+                            text += section_filter.feed(buf[:safe]) if section_filter else buf[:safe]
+                        else:
+                            dropped = True
+                        del buf[:safe]
+                    if not fill():
+                        # EOF only ends the last commit's patch; earlier, git stopped midway
+                        if next_header:
+                            raise RuntimeError(f"git diff-tree output ended inside a patch in {repo_path}")
+                        end = len(buf)
+                        break
+            if len(text) <= byte_budget:
+                text += section_filter.feed(buf[:end], final=True) if section_filter else buf[:end]
+            elif end:
+                dropped = True
+            del buf[:end]
+
+            joined = text.decode("utf-8", errors="replace")
+            # Cutting the decoded text keeps the cut on a character boundary
+            if dropped or len(joined) > max_diff_size:
+                joined = joined[:max_diff_size] + "...TRUNCATED"
+
+            # The last patch runs to EOF, so only git's exit status tells whether it is complete
+            if not next_header and proc.wait() != 0:
+                raise RuntimeError(f"git diff-tree exited with status {proc.returncode} in {repo_path}")
+
+            yield joined, list(affected_files)
+
+
+@dataclass
+class CommitInfo:
+    """A walked commit whose message is decoded once, for both filtering and history context."""
+
+    id: pygit2.Oid
+    message: str
+    subject: str
+    commit: pygit2.Commit
+
+
+def commit_info(commit):
+    message = commit.message
+    return CommitInfo(commit.id, message.strip(), message.split("\n", 1)[0], commit)
+
+
+def history_line(info):
+    """Format a commit as a one-line "<short id> <subject>" history entry."""
+    return f"{str(info.id)[:7]} {info.subject}"
+
+
+def count_tracked_files(repo):
+    """Number of index entries, or 0 when the repository has no index (bare)."""
+    try:
+        return len(repo.index)
+    except pygit2.GitError:
+        return 0
+
+def make_diff_worker(repo_path, max_diff_size):
+    """Returns a callable mapping a commit id to (diff_text, affected_files), or None on failure.
+
+    Each thread opens its own pygit2.Repository so no libgit2 objects are shared.
+    A commit that cannot be diffed is reported and skipped instead of aborting the repo.
+    """
+    local = threading.local()
+
+    def worker(commit_id):
+        repo = getattr(local, "repo", None)
+        if repo is None:
+            repo = local.repo = pygit2.Repository(repo_path)
+        try:
+            return get_commit_diff_and_files(repo, repo[commit_id], max_diff_size)
+        except (pygit2.GitError, KeyError, ValueError) as e:
+            print(f"  ⚠️  Skipping commit {str(commit_id)[:7]} in {repo_path}: {type(e).__name__}: {e}")
+            return None
+
+    return worker
+
+
+def iter_commit_diffs_with_fallback(repo, repo_path, commit_ids, max_diff_size, executor):
+    """Runs iter_commit_diffs_cli, switching to the pygit2 workers for the remaining commits if it fails."""
+    done = 0
+    try:
+        for result in iter_commit_diffs_cli(repo, repo_path, commit_ids, max_diff_size):
+            yield result
+            done += 1
+    except (RuntimeError, OSError, UnicodeDecodeError) as e:
+        print(f"  ⚠️  git diff-tree failed for {repo_path} ({e}); diffing the remaining commits with libgit2")
+        yield from executor.map(make_diff_worker(repo_path, max_diff_size), commit_ids[done:])
+
+
+def remove_partial_output(output_file):
+    """Deletes a half-written output file so later steps never mistake it for a complete one."""
+    try:
+        os.remove(output_file)
+    except OSError:
+        pass
+
+
+def repo_pack_size(repo_path):
+    """Total size of a repository's packfiles, a cheap proxy for how long it takes to process."""
+    pack_dir = os.path.join(repo_path, ".git", "objects", "pack")
+    try:
+        with os.scandir(pack_dir) as it:
+            return sum(entry.stat().st_size for entry in it if entry.name.endswith(".pack"))
+    except OSError:
+        return 0
+
 
 def process_repo(repo_path, args):
     repo_path = os.path.abspath(repo_path)
@@ -139,69 +509,89 @@ def process_repo(repo_path, args):
         return f"Skipped: {repo_path} (Not a valid git repo)"
 
     repo_name = os.path.basename(repo_path)
-    output_file = os.path.join(args.output_dir, f"{repo_name}.jsonl")
+    output_file = os.path.join(args.output_dir, f"{repo_name}.jsonl.zst" if args.zstd else f"{repo_name}.jsonl")
 
-    meta, contrib_content = get_repo_metadata(repo_path, args.include_license)
+    meta, contrib_content = get_repo_metadata(repo, repo_path, args.include_license, args.licensee_bin)
     if len(contrib_content) > args.max_contrib_size:
         contrib_content = contrib_content[: args.max_contrib_size] + "...TRUNCATED"
 
-    walker = repo.walk(repo.head.target, pygit2.GIT_SORT_TIME)
-    walker.hide(repo.head.target)
-
-    commits = []
-    history_lines = []
-
-    for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TIME):
-        if len(commit.parents) > 1:
-            continue  # no merges
-
-        msg = commit.message.split("\n", 1)[0]
-        history_lines.append(f"{str(commit.id)[:7]} {msg}")
-
-        commits.append(commit)
-        if len(commits) >= args.max_commits + 5:
-            break
+    # GIT_SORT_NONE streams commits by following parents instead of sorting the whole graph by time
+    non_merges = (c for c in repo.walk(repo.head.target, pygit2.GIT_SORT_NONE) if len(c.parents) <= 1)
+    commits = [commit_info(c) for c in itertools.islice(non_merges, args.max_commits + 5)]
+
+    # Filter commits and capture their context first; diffs are computed afterwards
+    selected = []
+    # Rolling view of the next five commits' "<short id> <subject>" lines; each line is
+    # formatted once, when it enters the window, and shifted at the top of each
+    # iteration so filtered commits still advance it
+    window = deque(map(history_line, commits[:5]), maxlen=5)
+    # Loop-invariant lookups bound to locals once rather than resolved per commit
+    num_commits = len(commits)
+    skip_bot_commits = args.skip_bot_commits
+    match_merge = REGEX_FILTER_MERGE.match
+    match_revert = REGEX_FILTER_REVERT.match
+    search_bot = BOT_PATTERN.search
+    for i, info in enumerate(commits[: args.max_commits]):
+        if i + 5 < num_commits:
+            window.append(history_line(commits[i + 5]))
+        else:
+            window.popleft()
+
+        msg = info.message
+
+        if match_merge(msg) or match_revert(msg) or msg.startswith(("squash!", "fixup!")):
+            continue
+
+        # The author signature is only materialized when the bot filter is on
+        if skip_bot_commits and search_bot(info.commit.author.name or ""):
+            continue
+
+        selected.append((info.id, msg, "\n".join(window)))
+
+    # Repo-level fields are written once, as a header line, instead of repeated in every entry
+    header = {"_meta": True, "license": meta["license"], "code_style": contrib_content}
+    if args.mark_source and "repo_source" in meta:
+        header["repo_source"] = meta["repo_source"]
 
     count = 0
+    buf = bytearray(orjson.dumps(header, option=orjson.OPT_APPEND_NEWLINE))
     try:
-        with open(output_file, "wb") as f:
-            for i, commit in enumerate(commits[: args.max_commits]):
-                msg = commit.message.strip()
-
-                if (
-                    REGEX_FILTER_MERGE.match(msg)
-                    or REGEX_FILTER_REVERT.match(msg)
-                    or msg.startswith(("squash!", "fixup!"))
-                ):
-                    continue
-
-                author_name = commit.author.name or ""
-                if args.skip_bot_commits and BOT_PATTERN.search(author_name):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.diff_threads) as executor, open_output(
+            output_file, args.zstd
+        ) as f:
+            commit_ids = [c[0] for c in selected]
+            if count_tracked_files(repo) > args.large_tree_threshold:
+                diffs = iter_commit_diffs_with_fallback(repo, repo_path, commit_ids, args.max_diff_size, executor)
+            else:
+                # Diffs are independent per commit; map() keeps them in commit order
+                diffs = executor.map(make_diff_worker(repo_path, args.max_diff_size), commit_ids)
+            dumps = orjson.dumps
+            append_newline = orjson.OPT_APPEND_NEWLINE
+            for (_, msg, recent_context), result in zip(selected, diffs):
+                if result is None:
                     continue
-
-                recent_context = "\n".join(history_lines[i + 1 : i + 6])
-
-                diff_text, affected_files = get_commit_diff_and_files(
-                    repo, commit, args.max_diff_size
-                )
-
+                diff_text, affected_files = result
                 entry = {
                     "commit_msg": clean_message(msg),
                     "change": diff_text,
                     "recent_commits_message": recent_context,
-                    "license": meta["license"],
-                    "code_style": contrib_content,
                     "affected_files": affected_files,
                 }
 
-                if args.mark_source and "repo_source" in meta:
-                    entry["repo_source"] = meta["repo_source"]
-
-                f.write(serialize_json(entry))
+                buf += dumps(entry, option=append_newline)
                 count += 1
+                if len(buf) >= WRITE_BUFFER_SIZE:
+                    f.write(buf)
+                    buf.clear()
+
+            f.write(buf)
 
     except OSError as e:
+        remove_partial_output(output_file)
         return f"File Error for {repo_name}: {e}"
+    except BaseException:
+        remove_partial_output(output_file)
+        raise
 
     return f"✅ Extracted {count} commits from {repo_name}"
 
@@ -251,7 +641,21 @@ def main():
         "-t",
         type=int,
         default=DEFAULTS["threads"],
-        help=f"Number of repositories to process concurrently using a ThreadPool (default: {DEFAULTS['threads']})",
+        help=f"Number of repositories to process concurrently in separate worker processes (default: {DEFAULTS['threads']})",
+    )
+
+    parser.add_argument(
+        "--diff-threads",
+        type=int,
+        default=DEFAULTS["diff_threads"],
+        help=f"Number of threads computing commit diffs within each repository (default: {DEFAULTS['diff_threads']})",
+    )
+
+    parser.add_argument(
+        "--large-tree-threshold",
+        type=int,
+        default=DEFAULTS["large_tree_threshold"],
+        help=f"Repositories tracking more files than this are diffed with 'git diff-tree' instead of libgit2 (default: {DEFAULTS['large_tree_threshold']})",
     )
 
     parser.add_argument(
@@ -265,7 +669,13 @@ def main():
         "--mark-source",
         "-s",
         action="store_true",
-        help="Include the repository's remote fetch URL in every JSONL entry for traceability",
+        help="Include the repository's remote fetch URL in each output file's metadata header for traceability",
+    )
+
+    parser.add_argument(
+        "--zstd",
+        action="store_true",
+        help="Write zstd-compressed '<repo>.jsonl.zst' files instead of plain JSONL. Requires the 'zstandard' package.",
     )
 
     parser.add_argument(
@@ -276,7 +686,15 @@ def main():
 
     args = parser.parse_args()
 
+    if args.zstd and not HAS_ZSTD:
+        parser.error("--zstd requires the 'zstandard' package")
+
     args.max_commits = clamp(args.max_commits, 1, 2147483647 - 5)
+    args.diff_threads = max(1, args.diff_threads)
+    # Resolved once here so workers don't fork/exec a missing binary for every repo
+    args.licensee_bin = shutil.which("licensee") if args.include_license else None
+    if args.include_license and args.licensee_bin is None:
+        print("⚠️  'licensee' not found on PATH; licenses will be reported as missing")
 
     abs_base = os.path.abspath(args.repos_dir)
     print(f"Looking for repositories in: {abs_base}")
@@ -289,7 +707,9 @@ def main():
         os.makedirs(args.output_dir)
 
     # Resolve subdirectories
-    subdirs = [os.path.join(abs_base, d) for d in os.listdir(abs_base) if os.path.isdir(os.path.join(abs_base, d))]
+    # DirEntry.is_dir() reuses the type from the directory listing instead of a stat per entry
+    with os.scandir(abs_base) as it:
+        subdirs = [entry.path for entry in it if entry.is_dir()]
     repos = [d for d in subdirs if os.path.isdir(os.path.join(d, ".git"))]
 
     print(f"Found {len(subdirs)} subdirectories, {len(repos)} valid Git repos.")
@@ -298,7 +718,16 @@ def main():
         print("❌ No valid Git repositories found. Stopping.")
         sys.exit(1)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
+    cpus = available_cpus()
+    if args.threads > cpus:
+        print(f"⚠️  --threads {args.threads} exceeds the {cpus} available CPUs; extra workers will mostly contend")
+
+    # Largest repositories first, so a big one started last does not leave a long straggler tail
+    repos.sort(key=repo_pack_size, reverse=True)
+
+    # fork starts workers without re-importing this module (spawn is the default outside Linux)
+    mp_context = multiprocessing.get_context("fork") if sys.platform.startswith("linux") else None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads, mp_context=mp_context) as executor:
         futures = {executor.submit(process_repo, r, args): r for r in repos}
         for future in tqdm(
             concurrent.futures.as_completed(futures),
@@ -311,7 +740,7 @@ def main():
                 if result:
                     tqdm.write(result)
             except Exception as e:
-                print(f"❌ Critical Thread Failure: {e}")
+                print(f"❌ Critical Worker Failure: {e}")
 
 
 if __name__ == "__main__":
@@ -1,67 +1,112 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import io
+import os
+from functools import partial
 from pathlib import Path
 
 try:
     import orjson as json  # way faster than standard json module
 
-    json._dumps = json.dumps
-    json.dumps = lambda content: json._dumps(content).decode("utf-8")
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj)
+
 except ImportError:
     import json
 
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+try:
+    import zstandard
+
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
 
 task_instruction = """You are an AI assistant that writes concise, high-quality Git commit messages.
 Task: Refer to the information provided, and then write a concise, imperative commit message describing the change.\n\n"""
 
 def format_prompt(sample, min_length: int = 3, add_instruction_prompt: bool = True):
-    parts = []
+    # Reject short targets before any of the prompt is built
+    target = sample.get("commit_msg", "").strip()
+    if not target or len(target) < min_length:
+        return None
 
-    # 1. Affected files
     affected = sample.get("affected_files", [])
     affected_str = ", ".join(affected) if affected else "(none)"
-    parts.append(f"Affected files: {affected_str}")
-
-    # 2. Change
     change = sample.get("change", "(none)").strip()
-    parts.append(f"Diff (code changes): {change}")
-
-    # 3. Recent commits message
     recent = sample.get("recent_commits_message", "(none)").strip()
-    parts.append(f"Recent commit examples: {recent}")
-
-    # 4. Code style
-    code_style = sample.get("code_style", "").strip()
-    if code_style:
-        parts.append(f"Code style guidelines: {code_style}")
-    else:
-        parts.append("Code style guidelines: (not specified)")
+    code_style = sample.get("code_style", "").strip() or "(not specified)"
+
+    # Assembled in one f-string rather than a list of sections joined afterwards
+    prompt = (
+        f"{task_instruction if add_instruction_prompt else ''}"
+        f"Affected files: {affected_str}\n"
+        f"Diff (code changes): {change}\n"
+        f"Recent commit examples: {recent}\n"
+        f"Code style guidelines: {code_style}\n"
+        "Commit message:"
+    )
+    return prompt, target
 
-    # 5. Commit message header
-    parts.append("Commit message:")
 
-    prompt = "\n".join(parts)
-    target = sample.get("commit_msg", "").strip()
+def open_input(jsonl_path: Path):
+    """Opens a .jsonl or zstd-compressed .jsonl.zst file for binary line iteration."""
+    if jsonl_path.suffix == ".zst":
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(jsonl_path, "rb"), closefd=True))
+    return open(jsonl_path, "rb")
 
-    if not target or len(target) < min_length:
-        return None
 
-    prompt = task_instruction + prompt if add_instruction_prompt else prompt
-    return prompt, target
+def process_file(jsonl_path, min_length: int):
+    """Format one input file; returns (samples read, [serialized output lines])."""
+    total_samples = 0
+    lines = []
+    meta = {}
+    # Raw bytes go straight to the parser, skipping a decode/strip round trip per line
+    with open_input(jsonl_path) as in_f:
+        for line in in_f:
+            if not line or line.isspace():
+                continue
+            try:
+                sample = json.loads(line)
+                # The "_meta" header carries repo-level fields shared by every entry after it
+                if sample.get("_meta"):
+                    meta = {key: value for key, value in sample.items() if key != "_meta"}
+                    continue
+                for key, value in meta.items():
+                    sample.setdefault(key, value)
+                total_samples += 1
+
+                formatted = format_prompt(sample, min_length)
+                if formatted is None:
+                    continue
+
+                lines.append(dumps_bytes({"prompt": formatted[0], "target": formatted[1]}) + b"\n")
+
+            except json.JSONDecodeError:
+                continue
+
+    return total_samples, lines
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert JSONL commit data to LLM training format.")
-    parser.add_argument("input_dir", help="Directory containing .jsonl files")
+    parser.add_argument("input_dir", help="Directory containing .jsonl (or zstd-compressed .jsonl.zst) files")
     parser.add_argument("output_file", type=str, default="samples.jsonl", help="Output text file for LLM training")
     parser.add_argument(
         "--min-length", type=int, default=3, help="Minimum commit message length (inclusive), 0 = unlimited"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)",
+    )
     args = parser.parse_args()
 
-    if args.max_length == 0:
-        args.max_length = float("inf")
-
     input_dir = Path(args.input_dir)
     output_file = Path(args.output_file)
     output_file.parent.mkdir(parents=True, exist_ok=True)
@@ -69,27 +114,23 @@ def main():
     total_samples = 0
     written_samples = 0
 
-    with open(output_file, "w", encoding="utf-8") as out_f:
-        for jsonl_path in input_dir.glob("*.jsonl"):
-            with open(jsonl_path, "r", encoding="utf-8") as in_f:
-                for line in in_f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        sample = json.loads(line)
-                        total_samples += 1
-
-                        formatted = format_prompt(sample, args.min_length)
-                        if formatted is None:
-                            continue
-
-                        out_f.write(json.dumps({"prompt": formatted[0], "target": formatted[1]}))
-                        out_f.write("\n")
-                        written_samples += 1
-
-                    except json.JSONDecodeError:
-                        continue
+    worker = partial(process_file, min_length=args.min_length)
+    jsonl_paths = list(input_dir.glob("*.jsonl")) + list(input_dir.glob("*.jsonl.zst"))
+    if not HAS_ZSTD and any(path.suffix == ".zst" for path in jsonl_paths):
+        parser.error("reading .jsonl.zst files requires the 'zstandard' package")
+    # Files are independent, so they are formatted in parallel; only this process writes
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        # map() keeps input order, so the output is identical to a serial run
+        results = executor.map(worker, jsonl_paths) if executor else map(worker, jsonl_paths)
+        with open(output_file, "wb") as out_f:
+            for file_samples, lines in results:
+                total_samples += file_samples
+                written_samples += len(lines)
+                out_f.writelines(lines)
+    finally:
+        if executor:
+            executor.shutdown()
 
     print(f"Processed {total_samples} samples, wrote {written_samples} to {output_file}")
 